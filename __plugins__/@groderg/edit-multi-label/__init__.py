@@ -1,9 +1,22 @@
+from bson import ObjectId
+from pymongo import ReturnDocument
+
 import fiftyone.operators as foo
 import fiftyone.operators.types as types
+import fiftyone.core.odm as fo_odm
 import fiftyone as fo
+from fiftyone import ViewField as F
 
 GROUND_TRUTH = "ground_truth_multilabel"
 
+# Side collections of the label edits journal and of its counters by dataset.
+JOURNAL_COLLECTION = "groderg_label_journal"
+JOURNAL_SUMMARY_COLLECTION = "groderg_label_journal_summary"
+# Oldest edits of a dataset are dropped when its journal stores more sample ids than this.
+JOURNAL_MAX_IDS = 5_000_000
+# Maximum number of sample ids in one journal document, far below the mongodb 16MB limit.
+JOURNAL_CHUNK_IDS = 200_000
+
 # Return a list of unique occurence of label in an image for a fo.Classifictions
 def _get_labels(sample, field):
     return list(set([a["label"] for a in sample[field]["classifications"]])) if type(sample[field]) == fo.Classifications else []
@@ -45,6 +58,7 @@ class ManageModalLabel(foo.Operator):
     
     def execute(self, ctx):
         sample = ctx.dataset[ctx.current_sample]
+        deltas = []
         for group in ctx.dataset.classes:
             labels_to_manage = ctx.params.get(f"{group}_labels", [])
 
@@ -58,8 +72,10 @@ class ManageModalLabel(foo.Operator):
                 sample[group]["classifications"].append(fo.Classification(label=la))
             
             _removeLabelClassifications(sample, group, label_to_remove)
+            deltas.append([sample.id, group, label_to_add, label_to_remove])
             
         sample.save()
+        _journal_edit(ctx.dataset, deltas)
 
 class AddGridLabel(foo.Operator):
     @property
@@ -91,6 +107,7 @@ class AddGridLabel(foo.Operator):
         return types.Property(inputs, view=form_view)
     
     def execute(self, ctx):
+        deltas = []
         for group in ctx.dataset.classes:
             labels_to_add = ctx.params.get(f"{group}_labels", None)
             if not labels_to_add: continue
@@ -100,10 +117,15 @@ class AddGridLabel(foo.Operator):
                 sample = ctx.dataset[sampleId]
                         
                 # Iter on each label and check if not in sample fields
+                added = []
                 for la in labels_to_add:
                     if not _label_in_fields(sample[group]["classifications"], la):
                         sample[group]["classifications"].append(fo.Classification(label=la))
+                        added.append(la)
                 sample.save()
+                deltas.append([sample.id, group, added, []])
+
+        _journal_edit(ctx.dataset, deltas)
 
 class RemoveGridLabel(foo.Operator):
     @property
@@ -134,6 +156,7 @@ class RemoveGridLabel(foo.Operator):
         return types.Property(inputs, view=form_view)
     
     def execute(self, ctx):
+        deltas = []
         for group in ctx.dataset.classes:
             labels_to_remove = ctx.params.get(f"{group}_labels", None)
             if not labels_to_remove: continue
@@ -141,8 +164,11 @@ class RemoveGridLabel(foo.Operator):
             # Iter on each selected samples
             for sampleId in ctx.selected:
                 sample = ctx.dataset[sampleId]
-                _removeLabelClassifications(sample, group, labels_to_remove)
+                removed = _removeLabelClassifications(sample, group, labels_to_remove)
                 sample.save()
+                deltas.append([sample.id, group, [], removed])
+
+        _journal_edit(ctx.dataset, deltas)
 
 class CreateGroundTruthLabel(foo.Operator):
     @property
@@ -201,30 +227,338 @@ class DeleteGroundTruthLabel(foo.Operator):
         return ctx.params.get("delegate", False)
 
     def execute(self, ctx):
+        deltas = []
+        classes_before = _copy_classes(ctx.dataset)
         for group in ctx.dataset.classes:
             labelsToRemove = ctx.params.get(f"{group}_labels", None)
             if not labelsToRemove: continue
 
             # Iter on each samples and delete the label
             for sample in ctx.dataset.iter_samples(progress=True):
-                _removeLabelClassifications(sample, group, labelsToRemove)
+                removed = _removeLabelClassifications(sample, group, labelsToRemove)
                 sample.save()
+                deltas.append([sample.id, group, [], removed])
             
             for label in labelsToRemove:
                 if label in ctx.dataset.classes[group]:
                     ctx.dataset.classes[group].remove(label)
         
+        _journal_edit(ctx.dataset, deltas, classes=[classes_before, _copy_classes(ctx.dataset)])
+        ctx.trigger("reload_dataset")
+
+class RenameGroundTruthLabel(foo.Operator):
+    @property
+    def config(self):
+        return foo.OperatorConfig(
+            name="rename_gt_label",
+            label="Rename or merge ground_truth label",
+            light_icon="/assets/icon-create-light.svg",
+            dark_icon="/assets/icon-create-dark.svg",
+            dynamic=True,
+        )
+
+    def resolve_input(self, ctx):
+        inputs = types.Object()
+        # Groups labels.
+        dropdown_groups = types.DropdownView(description="Choose which group labels to edit")
+        for group in ctx.dataset.classes:
+            dropdown_groups.add_choice(group, label=group)
+
+        inputs.enum("groups", dropdown_groups.values(), view=dropdown_groups, default=dropdown_groups.choices[0].value)
+        group = ctx.params.get("groups", None) or dropdown_groups.choices[0].value
+
+        # Labels to rename, selecting more than one merge them.
+        dropdown_labels = types.DropdownView(label="Labels", description="Select one or more labels to rename or merge")
+        for lb in ctx.dataset.classes.get(group, []):
+            dropdown_labels.add_choice(lb, label=lb)
+        inputs.list("labels", types.String(), view=dropdown_labels, required=True)
+        inputs.str("new_label", label="New label", required=True)
+
+        inputs.bool(
+            "delegate",
+            default=False,
+            label="Delegate execution?",
+            description="Check this box to delegate execution of this task",
+            view=types.CheckboxView(),
+        )
+
+        return types.Property(inputs, view=types.View(label="Rename or merge ground_truth label"))
+
+    def resolve_delegation(self, ctx):
+        return ctx.params.get("delegate", False)
+
+    def execute(self, ctx):
+        group = ctx.params.get("groups", None)
+        labels_to_rename = ctx.params.get("labels", None)
+        new_label = ctx.params.get("new_label", None)
+        if not group or not labels_to_rename or not new_label: return
+
+        _rename_labels(ctx.dataset, group, {la: new_label for la in labels_to_rename})
+
+        ctx.trigger("reload_dataset")
+
+def _rename_labels(dataset, group, mapping):
+    # Only samples with at least one label to rename are read and written.
+    view = dataset.match(F(f"{group}.classifications.label").contains(list(mapping))).select_fields(group)
+    ids, classifications = view.values(["id", f"{group}.classifications"])
+    classes_before = _copy_classes(dataset)
+
+    # Rename labels and drop the duplicates created by a merge, keep the first occurence.
+    deltas = []
+    for sample_id, sample_classifications in zip(ids, classifications):
+        labels_before = set(a.label for a in sample_classifications)
+        seen = set()
+        merged = []
+        for classification in sample_classifications:
+            classification.label = mapping.get(classification.label, classification.label)
+            if classification.label in seen: continue
+            seen.add(classification.label)
+            merged.append(classification)
+        sample_classifications[:] = merged
+        deltas.append([sample_id, group, sorted(seen - labels_before), sorted(labels_before - seen)])
+
+    view.set_values(f"{group}.classifications", classifications)
+
+    # Update classes in one write.
+    classes = dict(dataset.classes)
+    group_classes = []
+    for label in classes.get(group, []):
+        label = mapping.get(label, label)
+        if label not in group_classes:
+            group_classes.append(label)
+    for label in mapping.values():
+        if label not in group_classes:
+            group_classes.append(label)
+    classes[group] = group_classes
+    dataset.classes = classes
+    dataset.save()
+
+    _journal_edit(dataset, deltas, classes=[classes_before, _copy_classes(dataset)])
+
+class UndoLabelEdit(foo.Operator):
+    @property
+    def config(self):
+        return foo.OperatorConfig(
+            name="undo_label_edit",
+            label="Undo label edit",
+            light_icon="/assets/icon-grid-light.svg",
+            dark_icon="/assets/icon-grid-dark.svg",
+        )
+
+    def resolve_placement(self, ctx):
+        return types.Placement(
+            types.Places.SAMPLES_GRID_SECONDARY_ACTIONS,
+            types.Button(
+                label="Undo label edit",
+                prompt=False,
+            ),
+        )
+
+    def execute(self, ctx):
+        # Undo the newest done edit
+        record = _find_journal_edit(ctx.dataset, "done", -1)
+        if record is None: return
+
+        _apply_journal_edit(ctx.dataset, record, inverse=True)
+        _set_journal_state(ctx.dataset, record["seq"], "undone")
+
+        ctx.trigger("reload_dataset")
+
+class RedoLabelEdit(foo.Operator):
+    @property
+    def config(self):
+        return foo.OperatorConfig(
+            name="redo_label_edit",
+            label="Redo label edit",
+            light_icon="/assets/icon-grid-light.svg",
+            dark_icon="/assets/icon-grid-dark.svg",
+        )
+
+    def resolve_placement(self, ctx):
+        return types.Placement(
+            types.Places.SAMPLES_GRID_SECONDARY_ACTIONS,
+            types.Button(
+                label="Redo label edit",
+                prompt=False,
+            ),
+        )
+
+    def execute(self, ctx):
+        # Redo the last undone edit, which is the oldest undone one
+        record = _find_journal_edit(ctx.dataset, "undone", 1)
+        if record is None: return
+
+        _apply_journal_edit(ctx.dataset, record, inverse=False)
+        _set_journal_state(ctx.dataset, record["seq"], "done")
+
         ctx.trigger("reload_dataset")
 
+# The journal is a side collection keyed by dataset id, with one or more chunk documents by edit:
+#   {"dataset_id": ObjectId, "seq": int, "chunk": int, "state": "done" | "undone", "n_ids": int,
+#    "ops": [{"group": str, "added": [label], "removed": [label], "ids": [ObjectId]}, ...],
+#    "classes": {group: {"added": [label], "removed": [label]}}}
+# Samples of an edit with the same added and removed labels share one op, so a bulk
+# delete or rename stores its labels once with the list of affected ids.
+# A summary document by dataset {"_id": dataset_id, "next_seq": int, "n_ids": int} allocates
+# seq atomically and keeps the number of stored ids without reading the journal.
+_journal_ready = False
+
+def _journal_collections():
+    global _journal_ready
+    db = fo_odm.get_db_conn()
+    journal, summary = db[JOURNAL_COLLECTION], db[JOURNAL_SUMMARY_COLLECTION]
+
+    # Indexes are created and journals of deleted datasets purged once by process
+    if not _journal_ready:
+        journal.create_index([("dataset_id", 1), ("seq", 1), ("chunk", 1)], unique=True)
+        journal.create_index([("dataset_id", 1), ("state", 1), ("seq", 1), ("n_ids", 1)])
+        _purge_deleted_journals(db)
+        _journal_ready = True
+    return journal, summary
+
+def _purge_deleted_journals(db):
+    dataset_ids = db.datasets.distinct("_id")
+    db[JOURNAL_COLLECTION].delete_many({"dataset_id": {"$nin": dataset_ids}})
+    db[JOURNAL_SUMMARY_COLLECTION].delete_many({"_id": {"$nin": dataset_ids}})
+
+def _copy_classes(dataset):
+    return {group: list(labels) for group, labels in dataset.classes.items()}
+
+# Return added and removed labels by group between two dataset.classes
+def _classes_delta(before, after):
+    delta = {}
+    for group in list(before) + [g for g in after if g not in before]:
+        added = [la for la in after.get(group, []) if la not in before.get(group, [])]
+        removed = [la for la in before.get(group, []) if la not in after.get(group, [])]
+        if added or removed:
+            delta[group] = {"added": added, "removed": removed}
+    return delta
+
+def _journal_edit(dataset, deltas, classes=None):
+    ops = {}
+    for sample_id, group, added, removed in deltas:
+        if not added and not removed: continue
+        ops.setdefault((group, tuple(sorted(added)), tuple(sorted(removed))), []).append(ObjectId(sample_id))
+    classes = _classes_delta(*classes) if classes is not None else {}
+    if not ops and not classes: return
+
+    journal, summary = _journal_collections()
+    dataset_id = dataset._doc.id
+
+    # A new edit clears the edits which could be redone, the index covers the n_ids read
+    undone = list(journal.find({"dataset_id": dataset_id, "state": "undone"}, projection={"_id": 0, "n_ids": 1}))
+    if undone:
+        journal.delete_many({"dataset_id": dataset_id, "state": "undone"})
+        summary.update_one({"_id": dataset_id}, {"$inc": {"n_ids": -sum(doc["n_ids"] for doc in undone)}})
+
+    # Split ids in documents of at most JOURNAL_CHUNK_IDS ids, classes are on the first one
+    new_doc = lambda chunk: {"dataset_id": dataset_id, "chunk": chunk, "state": "done", "n_ids": 0, "ops": [], "classes": {}}
+    docs = [new_doc(0)]
+    docs[0]["classes"] = classes
+    for (group, added, removed), ids in ops.items():
+        for start in range(0, len(ids), JOURNAL_CHUNK_IDS):
+            chunk = ids[start:start+JOURNAL_CHUNK_IDS]
+            if docs[-1]["n_ids"] + len(chunk) > JOURNAL_CHUNK_IDS:
+                docs.append(new_doc(len(docs)))
+            docs[-1]["ops"].append({"group": group, "added": list(added), "removed": list(removed), "ids": chunk})
+            docs[-1]["n_ids"] += len(chunk)
+
+    # Allocate seq and count ids in one atomic update so concurrent edits never share a seq
+    counters = summary.find_one_and_update(
+        {"_id": dataset_id},
+        {"$inc": {"next_seq": 1, "n_ids": sum(doc["n_ids"] for doc in docs)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    for doc in docs:
+        doc["seq"] = counters["next_seq"] - 1
+    journal.insert_many(docs)
+
+    if counters["n_ids"] > JOURNAL_MAX_IDS:
+        _compact_journal(dataset)
+
+# Drop the oldest done edits while the journal stores too many ids, the newest done edit is always kept
+def _compact_journal(dataset):
+    journal, summary = _journal_collections()
+    dataset_id = dataset._doc.id
+
+    # Only indexed fields are read
+    edits = {}
+    cursor = journal.find({"dataset_id": dataset_id}, projection={"_id": 0, "seq": 1, "state": 1, "n_ids": 1}).sort("seq", 1)
+    for doc in cursor:
+        edit = edits.setdefault(doc["seq"], {"state": doc["state"], "n_ids": 0})
+        edit["n_ids"] += doc["n_ids"]
+
+    total = sum(edit["n_ids"] for edit in edits.values())
+    done = [seq for seq, edit in edits.items() if edit["state"] == "done"]
+    seqs_to_drop, n_dropped = [], 0
+    for seq in done[:-1]:
+        if total - n_dropped <= JOURNAL_MAX_IDS: break
+        n_dropped += edits[seq]["n_ids"]
+        seqs_to_drop.append(seq)
+
+    if seqs_to_drop:
+        journal.delete_many({"dataset_id": dataset_id, "seq": {"$in": seqs_to_drop}})
+    # Resynchronize the running total with the journal
+    summary.update_one({"_id": dataset_id}, {"$set": {"n_ids": total - n_dropped}})
+
+# Return the first edit with state in seq order (1) or reverse seq order (-1), merging its documents
+def _find_journal_edit(dataset, state, order):
+    journal, _ = _journal_collections()
+    dataset_id = dataset._doc.id
+    first = journal.find_one({"dataset_id": dataset_id, "state": state}, sort=[("seq", order)], projection=["seq"])
+    if first is None: return None
+
+    record = {"seq": first["seq"], "ops": [], "classes": {}}
+    for doc in journal.find({"dataset_id": dataset_id, "seq": first["seq"]}).sort("chunk", 1):
+        record["ops"] += doc["ops"]
+        record["classes"].update(doc["classes"])
+    return record
+
+def _set_journal_state(dataset, seq, state):
+    journal, _ = _journal_collections()
+    journal.update_many({"dataset_id": dataset._doc.id, "seq": seq}, {"$set": {"state": state}})
+
+# Apply an edit of the journal in bulk, inverse swap added and removed labels
+def _apply_journal_edit(dataset, record, inverse):
+    for op in record["ops"]:
+        added, removed = (op["removed"], op["added"]) if inverse else (op["added"], op["removed"])
+        group = op["group"]
+        view = dataset.select([str(sample_id) for sample_id in op["ids"]]).select_fields(group)
+        labels = view.values(group)
+
+        for index, sample_labels in enumerate(labels):
+            if sample_labels is None:
+                sample_labels = labels[index] = fo.Classifications(classifications=[])
+            existing_labels = set(a.label for a in sample_labels.classifications)
+            sample_labels.classifications = [a for a in sample_labels.classifications if a.label not in removed]
+            sample_labels.classifications += [fo.Classification(label=la) for la in added if la not in existing_labels]
+
+        view.set_values(group, labels)
+
+    # Only the labels changed by the edit are restored in classes, later changes are kept
+    if record["classes"]:
+        classes = _copy_classes(dataset)
+        for group, delta in record["classes"].items():
+            added, removed = (delta["removed"], delta["added"]) if inverse else (delta["added"], delta["removed"])
+            group_classes = [la for la in classes.get(group, []) if la not in removed]
+            group_classes += [la for la in added if la not in group_classes]
+            classes[group] = group_classes
+        dataset.classes = classes
+        dataset.save()
+
+# Return the list of unique labels removed from the sample
 def _removeLabelClassifications(sample, groups, labels_to_remove):
-    if sample[groups] == None: return 
+    if sample[groups] == None: return []
 
     # Iter on each labels and found label index to remove
     label_index_to_remove = [index for index, a in enumerate(sample[groups]["classifications"]) if a["label"] in labels_to_remove]
 
     # Iter on index to remove but reverse to not shift index position
+    removed = set()
     for index in label_index_to_remove[::-1]:
-        sample[groups]["classifications"].pop(index)
+        removed.add(sample[groups]["classifications"].pop(index)["label"])
+    return sorted(removed)
 
 def _install_manage_label(ctx, inputs):
     sample = ctx.dataset[ctx.current_sample]
@@ -254,4 +588,7 @@ def register(p):
     p.register(AddGridLabel)
     p.register(RemoveGridLabel)
     p.register(CreateGroundTruthLabel)
-    p.register(DeleteGroundTruthLabel)
\ No newline at end of file
+    p.register(DeleteGroundTruthLabel)
+    p.register(RenameGroundTruthLabel)
+    p.register(UndoLabelEdit)
+    p.register(RedoLabelEdit)
\ No newline at end of file
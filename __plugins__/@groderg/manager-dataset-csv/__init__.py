@@ -1,6 +1,16 @@
 import os
+import sys
 import cv2
-import pandas as pd
+import csv
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
 from pathlib import Path
 from datetime import datetime
 
@@ -10,6 +20,26 @@ import fiftyone.utils.data as foud
 import fiftyone.core.storage as fos
 import fiftyone.operators.types as types
 
+# Processes of the sharded export import the rows module by name from the plugin directory
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import groderg_csv_rows as csv_rows
+
+# Supported labels and tags files.
+LABELS_EXTENSIONS = [".csv", ".parquet", ".arrow"]
+
+# Layouts of labels and tags files, one-hot is one column by class, list and long are sparse.
+LABELS_LAYOUTS = ["one-hot", "list", "long"]
+LIST_DELIMITER = csv_rows.LIST_DELIMITER
+# Reserved names of sparse layouts: header of the list and long label column, and file name of the
+# row declaring every class, used or not.
+LIST_HEADER = "__labels__"
+LONG_HEADER = "__label__"
+CLASSES_ROW = "__classes__"
+
+# Number of row ranges by process of the sharded export, to balance the work between processes.
+SHARDS_BY_WORKER = 4
+
 class ImportDataset(foo.Operator):
     @property
     def config(self):
@@ -45,12 +75,11 @@ class ImportDataset(foo.Operator):
        
         # If we tags import tags.
         needTags = ctx.params.get("import_tags", False)
-        lb_file = None
+        tags_path = None
         for _, path in labels_files:
-            if "_labels.csv" in path:
-                lb_file = path
-        if not needTags or lb_file == None: return
-        tags_path = lb_file.replace("_labels.csv", "_tags.csv")
+            if _tags_path(path):
+                tags_path = _tags_path(path)
+        if not needTags or tags_path == None: return
         if not os.path.exists(tags_path): return
         _import_tags(dataset, tags_path)
 
@@ -82,25 +111,30 @@ class ExportDataset(foo.Operator):
         folder_path = _parse_path(ctx, "folder_path")
         exportingTag = ctx.params.get("export_tags", None)
         author_name = ctx.params.get("author_name", "Organisation").replace(" ", "-").lower()
+        file_format = ctx.params.get("file_format", ".csv")
+        layout = ctx.params.get("labels_layout", "one-hot")
         ctx.trigger("reload_dataset")
         
         if not group_label or not folder_path: return
         current_time = str(datetime.now().strftime("%Y%m%d_%H%M%S"))  
+        file_name = f"{current_time}__{author_name}__{ctx.dataset.name}__{group_label}"
 
-        # Export labels.
-        csv_exporter = CSVLabelsDatasetExporter(
-            export_dir=folder_path,
-            file_name=f"{current_time}__{author_name}__{ctx.dataset.name}__{group_label}",
-            default_classes=ctx.dataset.classes[group_label]
-        )
-        ctx.dataset.export(dataset_exporter=csv_exporter)
-        
-        # Export tags.
-        if not exportingTag: return 
-        default_tags = _get_all_tags(ctx.dataset)
-        if default_tags == []: return
-        csv_tags_path = os.path.join(folder_path, current_time+"_tags.csv")
-        _export_csv_tags(ctx.dataset, default_tags, csv_tags_path)
+        labels_path = os.path.join(folder_path, file_name+"_labels"+file_format)
+        tags_path = os.path.join(folder_path, file_name+"_tags"+file_format) if exportingTag else None
+
+        # Ensure the base output directory exists
+        os.makedirs(folder_path, exist_ok=True)
+
+        # Only fetch the fields needed from the selected samples or the current view.
+        view = _get_target_view(ctx).select_fields(group_label)
+
+        # Sharded export, only for csv files which can be concatenated.
+        if ctx.params.get("sharded", False) and file_format == ".csv":
+            num_workers = ctx.params.get("num_workers", None) or os.cpu_count()
+            _export_sharded(view, group_label, ctx.dataset.classes[group_label], labels_path, tags_path, layout, num_workers)
+            return
+
+        _export_view(view, group_label, ctx.dataset.classes[group_label], labels_path, tags_path, layout)
 
 
 def _install_import(ctx, inputs):
@@ -143,12 +177,12 @@ def _install_import(ctx, inputs):
         required=True
     )
     
-    ext = ".csv"
+    exts = ", ".join(LABELS_EXTENSIONS)
     prop_file = labels_list.file(
         "labels_path",
         required=True,
         label="Path to labels file",
-        description=f"Choose a {ext} file with the labels",
+        description=f"Choose a {exts} file with the labels",
         view=types.View(space=6),
     )
     
@@ -165,9 +199,9 @@ def _install_import(ctx, inputs):
 
     # Check for file extension.
     for lb in labels_paths:
-        if os.path.splitext(lb)[1] != ext:
+        if os.path.splitext(lb)[1] not in LABELS_EXTENSIONS:
             prop_file.invalid = True
-            prop_file.error_message = f"Please provide a {ext} path"
+            prop_file.error_message = f"Please provide a {exts} path"
             return False
     # Check for different names.
     if len(set(labels_names)) != len(labels_names):
@@ -189,29 +223,28 @@ def _install_import(ctx, inputs):
         "import_tags",
         default=False,
         label="Tags",
-        description=("Import tags from a csv who have a matching name with labels file"),
+        description=("Import tags from a file who have a matching name with labels file"),
         view=types.CheckboxView(),
     )
     
     needTags = ctx.params.get("import_tags", False)
     if needTags:
-        lb_with = None
+        potential_tags_path = None
         for lb in labels_paths:
-            if "_labels.csv" in lb:
-                lb_with = lb
+            if _tags_path(lb):
+                potential_tags_path = _tags_path(lb)
                 break
-        if lb_with == None:
+        if potential_tags_path == None:
             inputs.view(
                 "warning",
-                types.Error(label=f"Label doesn't have _labels.csv. Cannot find corresponding tag csv file"),
+                types.Error(label=f"Label doesn't have _labels suffix. Cannot find corresponding tag file"),
             )
             return False
-        potential_csv_path = lb_with.replace("_labels.csv", "_tags.csv")
-        isExisting = os.path.exists(potential_csv_path)
+        isExisting = os.path.exists(potential_tags_path)
         if not isExisting:
             inputs.view(
                 "warning",
-                types.Error(label=f"File {potential_csv_path} doesn't exist."),
+                types.Error(label=f"File {potential_tags_path} doesn't exist."),
             )
             return False
     return True
@@ -237,18 +270,17 @@ def _import_labels(dataset_name, dataset_dir, labels_path, persistent):
         persistent=persistent
     )
 
+    # Classes are kept from the parse of each labels file
+    classes_for_label = {first_label_name: csv_importer.classes}
+
     # Process all other labels
     for label_name, label_path in labels_path[1:]:
         # dataset.add_sample_field(label_name, fo.EmbeddedDocumentField)
-        df = pd.read_csv(label_path)
+        classes_for_label[label_name], rows = _read_labels_file(label_path)
         # Build a dict with filename: [label]
         labels_for_file = {}
-        for _, row in df.iterrows():
-            name = row.iloc[0]
-            labels_for_file[name] = []
-            for class_label in range(len(df.columns)):
-                if row.iloc[class_label] == 1:
-                    labels_for_file[name].append(fo.Classification(label=df.columns[class_label]))
+        for name, labels in rows:
+            labels_for_file[name] = [fo.Classification(label=label) for label in labels]
 
         for sample in dataset.iter_samples(progress=True):
             b = fo.Classifications() 
@@ -275,26 +307,29 @@ def _import_labels(dataset_name, dataset_dir, labels_path, persistent):
             sample.save()
 
     # Store labels for each classes in classes
-    for label_name, label_path in labels_path:
-        with open(label_path, "r") as file:
-            for row in file:
-                dataset.classes[label_name] = row.replace("\n", "").split(',')[1:]
-                break
+    for label_name, _ in labels_path:
+        dataset.classes[label_name] = classes_for_label[label_name]
     dataset.save()
     return dataset
 
 def _import_tags(dataset, tags_path):
     # Read and update tags
-    df = pd.read_csv(tags_path)
+    _, rows = _read_labels_file(tags_path)
+    tags_for_file = dict(rows)
     for sample in dataset.iter_samples():
-        row = df[df["FileName"] == sample.filename].iloc[:, 1:]
-        for tag in row:
-            if (row[tag] == 1).iloc[0]:
-                sample.tags.append(tag)
+        for tag in tags_for_file.get(sample.filename, []):
+            sample.tags.append(tag)
         sample.save()
 
 def _install_export(ctx, inputs):
 
+    # Exported samples.
+    if ctx.selected:
+        target_label = f"The {len(ctx.selected)} selected samples will be exported"
+    else:
+        target_label = "The samples of the current view will be exported"
+    inputs.view("target", types.Notice(label=target_label))
+
     # Author name.
     inputs.str("author_name", label="Author name", default="", required=True)
 
@@ -313,10 +348,44 @@ def _install_export(ctx, inputs):
         "export_tags",
         default=False,
         label="Tags",
-        description=("Export another csv file for tags associated to samples?"),
+        description=("Export another file for tags associated to samples?"),
         view=types.CheckboxView(),
     )
 
+    format_choices = types.Choices()
+    for ext in LABELS_EXTENSIONS:
+        format_choices.add_choice(ext, label=ext[1:])
+
+    inputs.enum("file_format",
+                format_choices.values(),
+                view=format_choices,
+                label="File format",
+                description="Choose the format of the exported files",
+                default=LABELS_EXTENSIONS[0])
+
+    layout_choices = types.Choices()
+    layout_choices.add_choice("one-hot", label="One-hot", description="One 0/1 column by label")
+    layout_choices.add_choice("list", label="List", description=f"FileName,{LIST_HEADER} with labels separated by {LIST_DELIMITER}")
+    layout_choices.add_choice("long", label="Long", description=f"FileName,{LONG_HEADER} with one row by label")
+
+    inputs.enum("labels_layout",
+                layout_choices.values(),
+                view=layout_choices,
+                label="Layout",
+                description="Choose how labels are written, sparse layouts are smaller when images have few labels",
+                default=LABELS_LAYOUTS[0])
+
+    if ctx.params.get("file_format", ".csv") == ".csv":
+        inputs.bool(
+            "sharded",
+            default=False,
+            label="Sharded export",
+            description=("Format rows in parallel processes, useful for very large datasets"),
+            view=types.CheckboxView(),
+        )
+        if ctx.params.get("sharded", False):
+            inputs.int("num_workers", label="Number of processes", default=os.cpu_count(), min=1)
+
     file_explorer = types.FileExplorerView(button_label="Choose a file...", choose_dir=True)
     inputs.file(
         "folder_path",
@@ -375,20 +444,191 @@ def _glob_files(directory=None, glob_patt=None):
 
     return fos.get_glob_matches(glob_patt)
 
-def _get_all_tags(dataset):
-    tags = []
-    for sample in dataset.iter_samples(progress=True):
-        tags = tags + sample.tags
-    return list(set(tags))
-
-def _export_csv_tags(dataset, default_tags, csv_tags_path):
-    # Write the labels CSV file
-    with open(csv_tags_path, "w") as f:
-        f.write("FileName,"+",".join(default_tags)+"\n")
-        for sample in dataset.iter_samples(progress=True):
-            filename = Path(sample.filepath).name
-            row = ["1" if default_tag in sample.tags else "0" for default_tag in default_tags]
-            f.write(filename+","+",".join(row)+"\n")
+def _get_target_view(ctx):
+    if ctx.selected:
+        return ctx.view.select(ctx.selected, ordered=True)
+    return ctx.view
+
+def _get_export_rows(view, group_label):
+    # Return (filename, [label]) rows and (filename, [tag]) rows with a projection on the needed fields
+    filepaths, labels, tags = view.values(["filepath", f"{group_label}.classifications.label", "tags"])
+    filenames = [Path(filepath).name for filepath in filepaths]
+    labels_rows = [(filename, sample_labels or []) for filename, sample_labels in zip(filenames, labels)]
+    tags_rows = [(filename, sample_tags or []) for filename, sample_tags in zip(filenames, tags)]
+    return labels_rows, tags_rows
+
+def _export_view(view, group_label, default_classes, labels_path, tags_path, layout):
+    labels_rows, tags_rows = _get_export_rows(view, group_label)
+    default_tags = sorted(set(tag for _, sample_tags in tags_rows for tag in sample_tags))
+
+    _write_labels_file(labels_path, sorted(default_classes), labels_rows, layout)
+    if tags_path and default_tags != []:
+        _write_labels_file(tags_path, default_tags, tags_rows, layout)
+
+def _export_sharded(view, group_label, default_classes, labels_path, tags_path, layout, num_workers):
+    labels_rows, tags_rows = _get_export_rows(view, group_label)
+
+    default_classes = sorted(default_classes)
+    default_tags = sorted(set(tag for _, sample_tags in tags_rows for tag in sample_tags))
+    files = [(labels_path, default_classes, labels_rows)]
+    if tags_path and default_tags != []:
+        files.append((tags_path, default_tags, tags_rows))
+
+    # Headers first so an invalid class name fails before any process starts
+    headers = [_csv_header(classes, layout) for _, classes, _ in files]
+
+    # Split rows in contiguous ranges to keep the view order, same as the non-sharded export
+    num_workers = max(1, min(num_workers, os.cpu_count() or 1))
+    parts, jobs = [[] for _ in files], []
+    for n_file, (path, classes, rows) in enumerate(files):
+        shard_size = max(1, -(-len(rows) // (num_workers * SHARDS_BY_WORKER)))
+        for n, start in enumerate(range(0, len(rows), shard_size)):
+            parts[n_file].append(f"{path}.part{n:04d}")
+            jobs.append((parts[n_file][-1], classes, rows[start:start + shard_size], layout))
+
+    try:
+        # Sparse rows cost about as much to send to a process as to format, only one-hot rows use processes.
+        # Spawned processes don't inherit the database client and threads of the server.
+        if num_workers > 1 and layout == "one-hot" and len(jobs) > 1:
+            try:
+                with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    list(executor.map(csv_rows.write_part, *zip(*jobs)))
+            except BrokenProcessPool:
+                # Processes can't start when the main module of the caller isn't import safe
+                for job in jobs:
+                    csv_rows.write_part(*job)
+        else:
+            for job in jobs:
+                csv_rows.write_part(*job)
+
+        for (path, _, _), header, file_parts in zip(files, headers, parts):
+            _concat_parts(path, header, file_parts)
+    finally:
+        for part in sum(parts, []):
+            if os.path.exists(part): os.remove(part)
+
+def _concat_parts(path, header, parts):
+    # Write header then parts in shard order and remove parts
+    with open(path, "w") as f:
+        f.write(header)
+        for part in parts:
+            with open(part, "r") as part_file:
+                shutil.copyfileobj(part_file, f)
+            os.remove(part)
+
+def _tags_path(labels_path):
+    # Return the tags file matching a labels file, None if labels file doesn't have _labels suffix
+    for ext in LABELS_EXTENSIONS:
+        if labels_path.endswith("_labels"+ext):
+            return labels_path[:-len("_labels"+ext)]+"_tags"+ext
+    return None
+
+def _read_table(path, columns):
+    # Read a labels file as an arrow table, uncompressed arrow files are memory-mapped without copy
+    ext = os.path.splitext(path)[1]
+    if ext == ".parquet":
+        return pq.read_table(path)
+    if ext == ".arrow":
+        return feather.read_table(path, memory_map=True)
+
+    # File names and sparse label columns are strings, one-hot columns are uint8 without type inference
+    if _detect_layout(columns) != "one-hot":
+        column_types = {columns[0]: pa.string(), columns[1]: pa.string()}
+    else:
+        column_types = {columns[0]: pa.string(), **{c: pa.uint8() for c in columns[1:]}}
+    return pa_csv.read_csv(path, convert_options=pa_csv.ConvertOptions(column_types=column_types))
+
+def _read_columns(path):
+    # Return the column names of a labels file without reading its rows
+    ext = os.path.splitext(path)[1]
+    if ext == ".parquet":
+        return pq.read_schema(path).names
+    if ext == ".arrow":
+        with pa.memory_map(path, "r") as source:
+            return pa.ipc.open_file(source).schema.names
+    with open(path, "r", newline="") as file:
+        return next(csv.reader(file))
+
+def _detect_layout(columns):
+    # Sparse layouts use reserved header names so a one-hot class can't be mistaken for them
+    if list(columns) == ["FileName", LIST_HEADER]:
+        return "list"
+    if list(columns) == ["FileName", LONG_HEADER]:
+        return "long"
+    return "one-hot"
+
+def _read_labels_file(path):
+    # Return the classes and a list of (filename, [label]) from a labels file of any layout
+    columns = _read_columns(path)
+    layout = _detect_layout(columns)
+    table = _read_table(path, columns)
+    filenames = table.column(0).to_pylist()
+
+    if layout == "one-hot":
+        # Each label column is read from the arrow buffers, only set positions are visited
+        classes = columns[1:]
+        labels_for_file = [[] for _ in filenames]
+        for n_class, class_label in enumerate(classes):
+            for n_row in np.flatnonzero(table.column(n_class + 1).to_numpy() == 1):
+                labels_for_file[n_row].append(class_label)
+        return classes, list(zip(filenames, labels_for_file))
+
+    values = [value or "" for value in table.column(1).to_pylist()]
+    # Keep order of first appearance without duplicates, an empty label is an image without label
+    labels_for_file = {}
+    for filename, value in zip(filenames, values):
+        labels = labels_for_file.setdefault(filename, [])
+        for la in (value.split(LIST_DELIMITER) if layout == "list" else [value]):
+            if la and la not in labels:
+                labels.append(la)
+
+    # Declared classes first, then labels used but not declared
+    classes = labels_for_file.pop(CLASSES_ROW, [])
+    rows = list(labels_for_file.items())
+    classes += sorted(set(la for _, labels in rows for la in labels) - set(classes))
+    return classes, rows
+
+def _csv_header(classes, layout):
+    # Sparse layouts declare the classes in a first row so unused classes are kept
+    if layout != "one-hot":
+        header = LIST_HEADER if layout == "list" else LONG_HEADER
+        return "FileName,"+header+"\n"+"".join(csv_rows.format_csv_rows(classes, [(CLASSES_ROW, classes)], layout))
+    return "FileName,"+",".join([csv_rows.csv_field(c) for c in classes])+"\n"
+
+def _write_labels_file(path, classes, rows, layout="one-hot"):
+    # Write a labels file from a list of (filename, [label]), format is given by path extension
+    ext = os.path.splitext(path)[1]
+    if ext == ".csv":
+        with open(path, "w") as f:
+            f.write(_csv_header(classes, layout))
+            f.writelines(csv_rows.format_csv_rows(classes, rows, layout))
+        return
+
+    if layout == "one-hot":
+        # Column major uint8 matrix so each label column is handed to arrow without copy
+        class_index = {c: i for i, c in enumerate(classes)}
+        one_hot = np.zeros((len(rows), len(classes)), dtype=np.uint8, order="F")
+        for n_row, (_, labels) in enumerate(rows):
+            for label in labels:
+                if label in class_index:
+                    one_hot[n_row, class_index[label]] = 1
+
+        columns = [pa.array([filename for filename, _ in rows], type=pa.string())]
+        columns += [pa.array(one_hot[:, i]) for i in range(len(classes))]
+        table = pa.table(columns, names=["FileName"]+list(classes))
+    else:
+        # Same columns as the csv sparse layouts
+        values = csv_rows.sparse_values(classes, [(CLASSES_ROW, classes)] + rows, layout)
+        filenames = [filename for filename, _ in values]
+        values = [value for _, value in values]
+        table = pa.table([pa.array(filenames, type=pa.string()), pa.array(values, type=pa.string())],
+                         names=["FileName", LIST_HEADER if layout == "list" else LONG_HEADER])
+
+    if ext == ".parquet":
+        pq.write_table(table, path)
+    else:
+        # Uncompressed to be memory-mapped on import
+        feather.write_feather(table, path, compression="uncompressed")
 
 
 class CSVLabelsDatasetImporter(foud.LabeledImageDatasetImporter):
@@ -409,6 +649,7 @@ class CSVLabelsDatasetImporter(foud.LabeledImageDatasetImporter):
         self._labels_file = None
         self._labels = None
         self._iter_labels = None
+        self.classes = None
         self.csv_labels = csv_labels
         self.dataset_dir = dataset_dir
 
@@ -445,28 +686,22 @@ class CSVLabelsDatasetImporter(foud.LabeledImageDatasetImporter):
 
     def setup(self):
         labels = []
-        df_multilabel = pd.read_csv(self.csv_labels)
-        filename = "FileName"
-
-        for _, row in df_multilabel.iterrows():
-            annotations_per_image = []
+        self.classes, rows = _read_labels_file(self.csv_labels)
 
+        for filename, image_labels in rows:
             # -- Metadata part
             # Get size_bytes of image
-            size_bytes = os.path.getsize(os.path.join(self.dataset_dir, str(row[filename])))
+            size_bytes = os.path.getsize(os.path.join(self.dataset_dir, filename))
             # Get height, width and channels
-            im = cv2.imread(os.path.join(self.dataset_dir, str(row[filename])))
+            im = cv2.imread(os.path.join(self.dataset_dir, filename))
             height, width, num_channels = im.shape
 
             # All class_label for the image
-            for class_label in range(len(df_multilabel.columns)):
-                if row.iloc[class_label] == 1:
-                    classification = fo.Classification(label=df_multilabel.columns[class_label])
-                    annotations_per_image.append(classification)
+            annotations_per_image = [fo.Classification(label=label) for label in image_labels]
             
             # Store all information
             labels.append((
-                os.path.join(self.dataset_dir, str(row[filename])),
+                os.path.join(self.dataset_dir, filename),
                 size_bytes, 
                 width, 
                 height, 
@@ -481,12 +716,13 @@ class CSVLabelsDatasetImporter(foud.LabeledImageDatasetImporter):
         pass
 
 class CSVLabelsDatasetExporter(foud.LabeledImageDatasetExporter):
-    def __init__(self, export_dir, file_name, default_classes):
+    def __init__(self, export_dir, file_name, default_classes, file_format=".csv", layout="one-hot"):
         self._labels_path = None
         self._labels = None
         self.export_dir = export_dir
-        self.labels_csv = file_name + "_labels.csv"
+        self.labels_csv = file_name + "_labels" + file_format
         self.default_classes = sorted(default_classes)
+        self.layout = layout
 
     @property
     def requires_image_metadata(self):
@@ -502,10 +738,9 @@ class CSVLabelsDatasetExporter(foud.LabeledImageDatasetExporter):
 
     def export_sample(self, image_or_path, label, metadata=None):
         labels_image = [label.classifications[n_label].label for n_label in range(len(label.classifications))]
-        row_label = ["1" if default_classe in labels_image else "0" for default_classe in self.default_classes]
         self._labels.append((
             image_or_path.split("/")[-1] if "/" in image_or_path else image_or_path.split("\\")[-1],
-            row_label,  # here, `row_label` is a list of 0 or 1 and position refering to the label in default classes
+            labels_image,
         ))
 
     def close(self, *args):
@@ -514,13 +749,9 @@ class CSVLabelsDatasetExporter(foud.LabeledImageDatasetExporter):
         if basedir and not os.path.isdir(basedir):
             os.makedirs(basedir)
 
-        # Write the labels CSV file
-        with open(self._labels_path, "w") as f:
-            f.write("FileName,"+",".join(self.default_classes)+"\n")
-
-            for row in self._labels:
-                f.write(row[0]+","+",".join(row[1])+"\n")
+        # Write the labels file
+        _write_labels_file(self._labels_path, self.default_classes, self._labels, self.layout)
 
 def register(p):
     p.register(ExportDataset)
-    p.register(ImportDataset)
\ No newline at end of file
+    p.register(ImportDataset)
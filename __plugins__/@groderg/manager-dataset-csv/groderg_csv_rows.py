@@ -0,0 +1,42 @@
+# Csv rows formatting of labels and tags files.
+# Only depends on the standard library so processes of the sharded export import it quickly.
+
+LIST_DELIMITER = ";"
+
+def csv_field(value):
+    # Quote a csv field containing a separator, a quote or a new line
+    if any(c in value for c in ',"\r\n'):
+        return '"'+value.replace('"', '""')+'"'
+    return value
+
+def sparse_values(classes, rows, layout):
+    # Return (filename, value) pairs of a sparse layout for a list of (filename, [label]), labels are deduplicated
+    if layout == "list":
+        for la in classes:
+            if LIST_DELIMITER in la:
+                raise ValueError(f"Label {la!r} contains the list delimiter {LIST_DELIMITER!r}, use the long or one-hot layout")
+    classes = set(classes)
+    values = []
+    for filename, labels in rows:
+        labels = [la for la in dict.fromkeys(labels) if la in classes]
+        if layout == "list":
+            values.append((filename, LIST_DELIMITER.join(labels)))
+        else:
+            values += [(filename, la) for la in labels] if labels else [(filename, "")]
+    return values
+
+def format_csv_rows(classes, rows, layout):
+    # Return the csv lines without header for a list of (filename, [label])
+    if layout != "one-hot":
+        return [csv_field(filename)+","+csv_field(value)+"\n" for filename, value in sparse_values(classes, rows, layout)]
+
+    lines = []
+    for filename, labels in rows:
+        labels = set(labels)
+        lines.append(csv_field(filename)+","+",".join(["1" if c in labels else "0" for c in classes])+"\n")
+    return lines
+
+def write_part(path, classes, rows, layout):
+    # Write the csv lines of a shard of rows without header
+    with open(path, "w") as f:
+        f.writelines(format_csv_rows(classes, rows, layout))